@@ -1,7 +1,10 @@
 import pandas as pd
 import plotly.express as px
-from dash import Dash, html, dcc, Input, Output
+from json import dumps as json_dumps
+from dash import Dash, html, dcc, Input, Output, State, ALL
+from dash.exceptions import PreventUpdate
 from pandas import read_parquet
+from process.postp.index import PopulationIndex
 
 df = read_parquet("output/stochastic_imputed_data.parquet")
 mapping_data = pd.read_excel("etc/sample_data/mapping.xlsx", sheet_name=None)
@@ -32,12 +35,22 @@ for col in df.columns:
         # Rows without a match in the dict will become NaN unless handled.
         df[col] = df[col].map(mappings[col]).fillna(df[col])
 
+# Index the population once, so every query is answered without masking df
+pop_index = PopulationIndex.from_dataframe(df)
+
 # Initialize the Dash app
 app = Dash(__name__)
 
 # Extract column names for dynamic generation
 columns = df.columns.tolist()
 
+FILTER_STYLE = {
+    "width": "23%",
+    "display": "inline-block",
+    "margin": "10px 1% 10px 0",
+    "verticalAlign": "top",
+}
+
 # 1. Define the Layout
 app.layout = html.Div(
     style={"fontFamily": "Arial, sans-serif", "padding": "20px"},
@@ -79,7 +92,7 @@ app.layout = html.Div(
                     [
                         html.Label(f"{col}:"),
                         dcc.Dropdown(
-                            id=f"filter-{col}",
+                            id={"type": "filter", "column": col},
                             options=[
                                 {"label": str(val), "value": val}
                                 for val in df[col].dropna().unique()
@@ -88,102 +101,108 @@ app.layout = html.Div(
                             placeholder=f"Select {col}...",
                         ),
                     ],
-                    id=f"filter-container-{col}",
-                    style={
-                        "width": "23%",
-                        "display": "inline-block",
-                        "margin": "10px 1% 10px 0",
-                        "verticalAlign": "top",
-                    },
+                    id={"type": "filter-container", "column": col},
+                    style=FILTER_STYLE,
                 )
                 for col in columns
             ]
         ),
+        # Compact query state: {"target": ..., "filters": {column: [values]}}
+        dcc.Store(id="query"),
         # Histogram Graph
         dcc.Graph(id="distribution-plot"),
     ],
 )
 
 
-# 2. Callback to hide the filter if it is the target column
-@app.callback(
-    [Output(f"filter-container-{col}", "style") for col in columns],
-    [Input("target-column", "value")],
+# 2. Clientside callback to hide the filter if it is the target column
+app.clientside_callback(
+    f"""
+    function(target_col) {{
+        const outputs = dash_clientside.callback_context.outputs_list;
+        const visible_style = {json_dumps(FILTER_STYLE)};
+        return outputs.map(
+            (item) => item.id.column === target_col ? {{display: "none"}} : visible_style
+        );
+    }}
+    """,
+    Output({"type": "filter-container", "column": ALL}, "style"),
+    Input("target-column", "value"),
 )
-def toggle_filters(target_col):
-    styles = []
-    for col in columns:
-        if col == target_col:
-            styles.append({"display": "none"})
-        else:
-            styles.append(
-                {
-                    "width": "23%",
-                    "display": "inline-block",
-                    "margin": "10px 1% 10px 0",
-                    "verticalAlign": "top",
-                }
-            )
-    return styles
-
-
-# --- NEW CALLBACK: Disable other dropdowns when one is in use ---
-@app.callback(
-    [Output(f"filter-{col}", "disabled") for col in columns],
-    [Input(f"filter-{col}", "value") for col in columns],
+
+
+# Clientside callback to disable other dropdowns when one is in use
+app.clientside_callback(
+    """
+    function(filter_values) {
+        const active_index = filter_values.findIndex((val) => val && val.length > 0);
+        return filter_values.map((val, i) => active_index !== -1 && i !== active_index);
+    }
+    """,
+    Output({"type": "filter", "column": ALL}, "disabled"),
+    Input({"type": "filter", "column": ALL}, "value"),
 )
-def disable_other_filters(*filter_values):
-    # Find if any filter currently has a selection
-    active_index = None
-    for i, val in enumerate(filter_values):
-        if val and len(val) > 0:  # If it's not None and not an empty list
-            active_index = i
-            break
-
-    disabled_states = []
-    for i in range(len(columns)):
-        if active_index is None:
-            # Nothing selected anywhere? Enable everything.
-            disabled_states.append(False)
-        elif i == active_index:
-            # This is the one currently being used. Keep it enabled.
-            disabled_states.append(False)
-        else:
-            # This is not the active one. Disable it.
-            disabled_states.append(True)
-
-    return disabled_states
-
-
-# 3. Callback for updating the histogram
-callback_inputs = [Input("target-column", "value")] + [
-    Input(f"filter-{col}", "value") for col in columns
-]
-
-
-@app.callback(Output("distribution-plot", "figure"), *callback_inputs)
-def update_histogram(target_col, *filter_values):
-    filtered_df = df.copy()
-    grouping_col = None
 
-    for col, selected_vals in zip(columns, filter_values):
-        if col == target_col:
-            continue
 
-        if selected_vals:
-            filtered_df = filtered_df[filtered_df[col].isin(selected_vals)]
+# Clientside callback to collect the target and the active filters into one
+# compact structure, only updated when the query actually changes
+app.clientside_callback(
+    """
+    function(target_col, filter_values, current_query) {
+        const filter_ids = dash_clientside.callback_context.inputs_list[1];
+        const filters = {};
+        filter_ids.forEach((item, i) => {
+            const val = filter_values[i];
+            if (item.id.column !== target_col && val && val.length > 0) {
+                filters[item.id.column] = val;
+            }
+        });
+
+        const query = {target: target_col, filters: filters};
+        if (JSON.stringify(query) === JSON.stringify(current_query)) {
+            return dash_clientside.no_update;
+        }
+        return query;
+    }
+    """,
+    Output("query", "data"),
+    Input("target-column", "value"),
+    Input({"type": "filter", "column": ALL}, "value"),
+    State("query", "data"),
+)
+
 
-            # Since only one column can be selected now, this will accurately
-            # capture the one active column to use for grouping if multiple values are picked
-            if len(selected_vals) > 1:
-                grouping_col = col
+# 3. Callback for updating the histogram (the only server round trip)
+@app.callback(Output("distribution-plot", "figure"), Input("query", "data"))
+def update_histogram(query):
+    if not query:
+        raise PreventUpdate
 
-    if filtered_df.empty:
+    target_col = query["target"]
+    filters = query["filters"]
+
+    # Since only one column can be selected now, this will accurately
+    # capture the one active column to use for grouping if multiple values are picked
+    grouping_col = None
+    for col, selected_vals in filters.items():
+        if len(selected_vals) > 1:
+            grouping_col = col
+
+    if grouping_col:
+        counts = pop_index.crosstab([target_col, grouping_col], filters)
+        counts = counts.stack().rename("count").reset_index()
+        counts[grouping_col] = counts[grouping_col].astype(str)
+    else:
+        counts = pop_index.value_counts(target_col, filters).reset_index()
+    counts = counts[counts["count"] > 0]
+
+    if counts.empty:
         return px.histogram(title="No data matches the selected filters.")
 
-    fig = px.histogram(
-        filtered_df,
+    fig = px.bar(
+        counts,
         x=target_col,
+        y="count",
         color=grouping_col,
         barmode="group" if grouping_col else "relative",
         title=f"Distribution of {target_col} based on selected filters",
@@ -1,11 +1,14 @@
 from process.data.sample import load_sample_data
 from process.model.stochastic_impute import stochastic_impute
 from process.postp.vis import plot_distribution
+from process.postp.validate import validate_fidelity
 
 data, task_list = load_sample_data(refresh=True)
 
 syn_pop = stochastic_impute(data, task_list)
 
+validate_fidelity(syn_pop, data, task_list, output_dir="./output")
+
 for proc_key in [
     ["age"],
     ["work_hours"],
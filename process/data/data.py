@@ -1,6 +1,9 @@
 from process.data.query import obtain_stats_data
 from process.data.utils import stats_data_proc
-from pandas import DataFrame as pdDataFrame
+from pandas import DataFrame
+from pandas import Series
+from logging import info as log_info
+import numpy as np
 from sklearn.preprocessing import LabelEncoder
 
 
@@ -56,7 +59,113 @@ def obtain_data(cfg: dict, api_key: str):
     return df
 
 
-def encode_weights(data_dict) -> dict:
+def compact_reference(
+    df: DataFrame, seed_cells: DataFrame, targets: list, fixed_cols: list
+) -> DataFrame:
+    """
+    Compacts an aggregated reference table (with a 'value' column) before
+    imputation, without changing any conditional distribution the seed can
+    look up:
+
+    1. Zero-value cells are dropped, unless a group they belong to (all the
+       other columns except one target) has no weight at all, since such groups
+       are sampled uniformly.
+    2. The table is restricted to the feature combinations present in the
+       seed (a semi-join on the columns shared with the seed, for each
+       missingness pattern of the seed).
+
+    The result is still a plain table: the conditional tables of each
+    missingness pattern are aggregated from it as before (see
+    ``get_conditional_tables``), only over fewer rows.
+
+    Args:
+        df (pandas.DataFrame): The aggregated reference table.
+        seed_cells (pandas.DataFrame): The seed population (or its distinct
+            cells).
+        targets (list): The targets imputed from this table.
+        fixed_cols (list): Columns that cannot be used in the semi-join, e.g.,
+            any column that is a target of some task (its values change
+            during imputation).
+
+    Returns:
+        pandas.DataFrame: The compacted reference table.
+    """
+    other_cols = df.columns.drop("value").tolist()
+
+    keep = df["value"] > 0
+    for proc_target in targets:
+        group_cols = [col for col in other_cols if col != proc_target]
+        if group_cols:
+            group_total = df.groupby(group_cols, dropna=False)["value"].transform(
+                "sum"
+            )
+        else:
+            group_total = Series(df["value"].sum(), index=df.index)
+        keep |= group_total <= 0
+    df = df[keep]
+
+    key_cols = [
+        col for col in other_cols if col in seed_cells.columns and col not in fixed_cols
+    ]
+    if key_cols and len(df) > 0:
+        seed_keys = seed_cells[key_cols].drop_duplicates()
+        seed_nulls = seed_keys.isna()
+
+        matched = np.zeros(len(df), dtype=bool)
+        for _, pattern in seed_nulls.drop_duplicates().iterrows():
+            valid_cols = [col for col in key_cols if not pattern[col]]
+            if not valid_cols:
+                matched[:] = True
+                break
+
+            pattern_keys = seed_keys.loc[
+                (seed_nulls == pattern).all(axis=1), valid_cols
+            ].drop_duplicates()
+            matched |= (
+                df[valid_cols]
+                .merge(pattern_keys, on=valid_cols, how="left", indicator=True)[
+                    "_merge"
+                ]
+                .eq("both")
+                .to_numpy()
+            )
+        df = df[matched]
+
+    return df.reset_index(drop=True)
+
+
+def encode_weights(
+    data_dict, task_list: dict or None = None, seed_cells=None
+) -> dict:
+    """
+    Expands the seed into unit records and turns every reference table into
+    a normalized 'probability' table.
+
+    Args:
+        data_dict (dict): The seed population and the reference tables.
+        task_list (dict or None, optional): If provided, the reference table
+            of each task is compacted against the seed (see
+            ``compact_reference``). Defaults to None.
+        seed_cells (pandas.DataFrame or None, optional): The seed used for the
+            compaction. Defaults to data_dict["seed"].
+
+    Returns:
+        dict: The encoded data.
+    """
+    if seed_cells is None:
+        seed_cells = data_dict.get("seed")
+    if seed_cells is not None and "value" in seed_cells.columns:
+        seed_cells = seed_cells[seed_cells["value"] > 0].drop(columns=["value"])
+
+    task_targets = {}
+    if task_list is not None:
+        task_targets = {
+            proc_task.strip(): list(task_list[proc_task]["targets"])
+            for proc_task in task_list
+        }
+    all_targets = [
+        proc_target for targets in task_targets.values() for proc_target in targets
+    ]
 
     for key in data_dict:
 
@@ -72,6 +181,15 @@ def encode_weights(data_dict) -> dict:
         else:
             group_cols = df.columns.drop("value").tolist()
             df_grouped = df.groupby(group_cols, as_index=False)["value"].sum()
+            if key in task_targets and seed_cells is not None:
+                proc_size = len(df_grouped)
+                df_grouped = compact_reference(
+                    df_grouped, seed_cells, task_targets[key], all_targets
+                )
+                log_info(
+                    f"Compacted reference '{key}': "
+                    + f"{proc_size} -> {len(df_grouped)} rows"
+                )
             df_grouped["probability"] = df_grouped["value"] / df_grouped["value"].sum()
             df = df_grouped.reset_index(drop=True).drop(columns=["value"])
 
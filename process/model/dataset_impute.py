@@ -0,0 +1,434 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pa_compute
+import pyarrow.dataset as pa_dataset
+import pyarrow.parquet as pq
+from logging import info as log_info
+from os.path import basename as os_path_basename
+from os.path import dirname as os_path_dirname
+from os.path import exists as os_path_exists
+from os.path import isdir as os_path_isdir
+from os.path import join as os_path_join
+from os import listdir as os_listdir
+from os import makedirs as os_makedirs
+from os import remove as os_remove
+from os import rename as os_rename
+from shutil import rmtree
+from process.data.data import encode_weights
+from process.model.stochastic_impute import check_sampling, impute_tasks
+from process.model.utils import check_deps_charts
+
+
+def iter_seed_batches(seed, batch_size: int = 1_000_000):
+    """
+    Iterates over the seed population in batches of unit records.
+
+    Args:
+        seed (pandas.DataFrame or str): Either the aggregated seed table (with
+            a 'value' column), which is expanded on the fly so the full
+            population is never materialized, or the path to a Parquet
+            file/dataset of unit records.
+        batch_size (int, optional): Number of records per batch.
+            Defaults to 1_000_000.
+
+    Yields:
+        pandas.DataFrame: The next batch of unit records.
+    """
+    if isinstance(seed, str):
+        for batch in pa_dataset.dataset(seed, format="parquet").to_batches(
+            batch_size=batch_size
+        ):
+            yield batch.to_pandas()
+        return
+
+    cells = seed.drop(columns=["value"]).reset_index(drop=True)
+    cum_values = np.cumsum(seed["value"].to_numpy(dtype=np.int64))
+    total = int(cum_values[-1]) if len(cum_values) else 0
+
+    for start in range(0, total, batch_size):
+        records = np.arange(start, min(start + batch_size, total))
+        cell_ids = np.searchsorted(cum_values, records, side="right")
+        yield cells.iloc[cell_ids].reset_index(drop=True)
+
+
+def obtain_seed_cells(seed, batch_size: int = 1_000_000) -> pd.DataFrame:
+    """
+    Returns the distinct cells of the seed population, scanning a Parquet
+    seed batch by batch.
+    """
+    if not isinstance(seed, str):
+        return seed
+
+    seed_cells = None
+    for batch_df in iter_seed_batches(seed, batch_size=batch_size):
+        if seed_cells is not None:
+            batch_df = pd.concat([seed_cells, batch_df], ignore_index=True)
+        seed_cells = batch_df.drop_duplicates()
+    return seed_cells
+
+
+def obtain_output_schema(seed, data_dict: dict, task_list: dict) -> pa.Schema:
+    """
+    Works out the Arrow schema of the imputed output, so that every batch is
+    written with the same column types.
+
+    The seed columns keep the types of the seed (the Parquet dataset schema,
+    or the aggregated seed table). Each target takes the type of the target in
+    the reference table it is first imputed from, since the imputed values are
+    drawn from that table; a "numeric" target that already exists when it is
+    imputed is averaged, so it becomes float64.
+    """
+    if isinstance(seed, str):
+        seed_schema = pa_dataset.dataset(seed, format="parquet").schema
+    else:
+        seed_schema = pa.Schema.from_pandas(
+            seed.drop(columns=["value"]), preserve_index=False
+        )
+
+    fields = {field.name: field.with_nullable(True) for field in seed_schema}
+    for proc_task in task_list:
+        ref_df = data_dict[proc_task.strip()]
+        shared_cols = set(fields).intersection(ref_df.columns)
+        if not shared_cols:
+            continue
+
+        for proc_target, target_type in task_list[proc_task]["targets"].items():
+            if proc_target not in fields:
+                fields[proc_target] = pa.Schema.from_pandas(
+                    ref_df[[proc_target]], preserve_index=False
+                ).field(proc_target).with_nullable(True)
+            elif target_type != "category":
+                fields[proc_target] = pa.field(proc_target, pa.float64())
+
+    return pa.schema(list(fields.values()))
+
+
+def stochastic_impute_dataset(
+    data_dict,
+    task_list,
+    output_dir="./output",
+    output_filename="stochastic_imputed_data.parquet",
+    sampling="random",
+    batch_size=1_000_000,
+    partition_cols=None,
+):
+    """
+    Out-of-core version of ``stochastic_impute`` for populations larger
+    than memory.
+
+    The population is processed in batches of unit records: each batch runs
+    through the whole task chain (the same code as ``stochastic_impute``)
+    and is appended as a row group to the output Parquet file, so the memory
+    used is bounded by the batch size. The conditional tables are compiled
+    once and shared across batches.
+
+    Note that with sampling="integerized" the expected counts are rounded
+    within each batch, so a group split across batches may be off by one
+    record per batch.
+
+    Args:
+        data_dict (dict): The reference tables, plus the 'seed', given either
+            as the aggregated seed table (with 'value') or as the path to a
+            Parquet file/dataset of unit records.
+        task_list (dict): The imputation tasks.
+        output_dir (str, optional): Where the output is saved.
+            Defaults to "./output".
+        output_filename (str, optional): Name of the output parquet file.
+        sampling (str, optional): See ``stochastic_impute``.
+        batch_size (int, optional): Number of records per batch.
+            Defaults to 1_000_000.
+        partition_cols (list or None, optional): If provided, the output is a
+            Parquet dataset (directory) partitioned by these seed columns
+            (hive layout), which ``append_seed_records`` can later update
+            partition by partition. Defaults to None (single Parquet file).
+
+    Returns:
+        str: Path to the imputed Parquet file (or dataset directory).
+    """
+    check_sampling(sampling)
+
+    seed = data_dict["seed"]
+    ref_dict = encode_weights(
+        {key: df for key, df in data_dict.items() if key != "seed"},
+        task_list=task_list,
+        seed_cells=obtain_seed_cells(seed, batch_size=batch_size),
+    )
+
+    if not os_path_exists(output_dir):
+        os_makedirs(output_dir)
+    check_deps_charts(task_list, output_dir=output_dir)
+
+    output_path = f"{output_dir}/{output_filename}"
+    schema = obtain_output_schema(seed, ref_dict, task_list)
+
+    imputed_batches = iter_imputed_batches(
+        seed, ref_dict, task_list, schema, sampling=sampling, batch_size=batch_size
+    )
+
+    # The output is written aside and then swapped in, so nothing from a
+    # previous run (e.g., partitions absent from this seed) is left behind
+    tmp_path = obtain_sibling_path(output_path, "tmp")
+    remove_path(tmp_path)
+    if partition_cols is None:
+        with pq.ParquetWriter(tmp_path, schema) as writer:
+            for batch in imputed_batches:
+                writer.write_batch(batch)
+    else:
+        pa_dataset.write_dataset(
+            imputed_batches,
+            tmp_path,
+            schema=schema,
+            format="parquet",
+            partitioning=obtain_partitioning(schema, partition_cols),
+            basename_template="part-{i}.parquet",
+        )
+    swap_path(tmp_path, output_path)
+
+    return output_path
+
+
+def iter_imputed_batches(
+    seed,
+    ref_dict: dict,
+    task_list: dict,
+    schema: pa.Schema,
+    sampling: str = "random",
+    batch_size: int = 1_000_000,
+):
+    """
+    Runs the task chain on every batch of the seed population.
+
+    Yields:
+        pyarrow.RecordBatch: The next imputed batch, cast to schema.
+    """
+    tables_cache = {}
+    for i, batch_df in enumerate(iter_seed_batches(seed, batch_size=batch_size)):
+        batch_df = impute_tasks(
+            batch_df,
+            ref_dict,
+            task_list,
+            sampling=sampling,
+            tables_cache=tables_cache,
+        )
+        log_info(f"Imputed batch {i} ({len(batch_df)} records)")
+        yield from pa.Table.from_pandas(
+            batch_df[schema.names], schema=schema, preserve_index=False
+        ).to_batches()
+
+
+def obtain_sibling_path(path: str, suffix: str) -> str:
+    """
+    Returns a hidden path next to path (e.g., "dir/.name.tmp"), which
+    Parquet dataset discovery skips.
+    """
+    return os_path_join(os_path_dirname(path), f".{os_path_basename(path)}.{suffix}")
+
+
+def remove_path(path: str):
+    """
+    Removes a file or a directory tree, if it exists.
+    """
+    if os_path_isdir(path):
+        rmtree(path)
+    elif os_path_exists(path):
+        os_remove(path)
+
+
+def swap_path(new_path: str, path: str):
+    """
+    Moves new_path (a file or directory) to path, replacing what is there.
+
+    The previous content is first renamed aside and only removed once the new
+    one is in place, so old and new records are never visible together: a
+    crash between the two renames leaves path missing, with the previous
+    content still in its hidden ".old" sibling.
+    """
+    old_path = obtain_sibling_path(path, "old")
+    remove_path(old_path)
+    if os_path_exists(path):
+        os_rename(path, old_path)
+    os_rename(new_path, path)
+    remove_path(old_path)
+
+
+def obtain_partitioning(schema: pa.Schema, partition_cols: list):
+    """
+    Returns the hive partitioning of the output dataset, with the partition
+    columns typed as in the output schema (so e.g. "09" is not read as 9).
+    """
+    return pa_dataset.partitioning(
+        pa.schema([schema.field(col) for col in partition_cols]), flavor="hive"
+    )
+
+
+def append_seed_records(
+    data_dict,
+    delta,
+    task_list,
+    partition_cols,
+    output_dir="./output",
+    output_filename="stochastic_imputed_data.parquet",
+    sampling="random",
+    batch_size=1_000_000,
+    random_seed=0,
+):
+    """
+    Incrementally updates an imputed dataset with new or changed seed cells.
+
+    Only the records of the cells in delta are imputed (through the full task
+    chain, with the same reference tables), and only the partitions holding
+    those cells are rewritten: in each of them, the existing records of the
+    delta cells are replaced by the new ones. All other partitions are left
+    untouched. The imputation uses its own random stream (random_seed), so
+    the same delta always gives the same records.
+
+    Args:
+        data_dict (dict): The reference tables used for the original run (the
+            'seed' entry, if any, is ignored).
+        delta (pandas.DataFrame): The new or changed seed cells, in the
+            aggregated seed format (seed columns + 'value'). The 'value' of a
+            cell is its new total count; a 'value' of 0 removes the cell. The
+            seed columns must not be targets of any task, since the existing
+            records of a cell are found by their seed values.
+        task_list (dict): The imputation tasks.
+        partition_cols (list): The partition columns of the dataset, as given
+            to ``stochastic_impute_dataset``.
+        output_dir (str, optional): Where the dataset is saved.
+            Defaults to "./output".
+        output_filename (str, optional): Name of the dataset directory.
+        sampling (str, optional): See ``stochastic_impute``.
+        batch_size (int, optional): Number of records per batch.
+            Defaults to 1_000_000.
+        random_seed (int, optional): Seed of the random stream used for the
+            delta. Defaults to 0.
+
+    Returns:
+        list: The rewritten partition directories.
+    """
+    check_sampling(sampling)
+
+    output_path = f"{output_dir}/{output_filename}"
+    key_cols = delta.columns.drop("value").tolist()
+
+    target_cols = [
+        col
+        for col in key_cols
+        if any(col in task_list[proc_task]["targets"] for proc_task in task_list)
+    ]
+    if target_cols:
+        raise ValueError(
+            f"Seed columns {target_cols} are also task targets: their values "
+            + "change during imputation, so the existing records of the delta "
+            + "cells cannot be found."
+        )
+
+    ref_dict = encode_weights(
+        {key: df for key, df in data_dict.items() if key != "seed"},
+        task_list=task_list,
+        seed_cells=delta,
+    )
+
+    # The partition columns are not stored in the files, so their types are
+    # taken from the delta
+    file_schema = pa_dataset.dataset(output_path, format="parquet").schema
+    file_schema = pa.schema(
+        [field for field in file_schema if field.name not in partition_cols]
+    )
+    partition_schema = pa.Schema.from_pandas(
+        delta[partition_cols], preserve_index=False
+    )
+    schema = pa.unify_schemas([partition_schema, file_schema])
+    partitioning = obtain_partitioning(schema, partition_cols)
+
+    # Impute the records of the delta cells with a deterministic random stream,
+    # tagging each record with its delta cell (_cell) to assign it afterwards
+    delta = delta.reset_index(drop=True)
+    impute_schema = schema.append(pa.field("_cell", pa.int64()))
+    random_state = np.random.get_state()
+    np.random.seed(random_seed)
+    try:
+        new_records = pa.Table.from_batches(
+            list(
+                iter_imputed_batches(
+                    delta[delta["value"] > 0].assign(_cell=lambda df: df.index),
+                    ref_dict,
+                    task_list,
+                    impute_schema,
+                    sampling=sampling,
+                    batch_size=batch_size,
+                )
+            ),
+            schema=impute_schema,
+        ).to_pandas()
+    finally:
+        np.random.set_state(random_state)
+
+    # Rewrite only the partitions holding the delta cells (null partition keys
+    # go to the hive default partition, as in stochastic_impute_dataset)
+    updated_partitions = []
+    for partition_keys, partition_delta in delta.groupby(
+        partition_cols, sort=False, dropna=False
+    ):
+        partition_keys = (
+            partition_keys if isinstance(partition_keys, tuple) else (partition_keys,)
+        )
+        partition_expr = None
+        for col, val in zip(partition_cols, partition_keys):
+            if pd.isna(val):
+                proc_expr = pa_compute.field(col).is_null()
+            else:
+                proc_expr = pa_compute.field(col) == pa.scalar(
+                    val, schema.field(col).type
+                )
+            partition_expr = (
+                proc_expr if partition_expr is None else partition_expr & proc_expr
+            )
+        partition_dir = os_path_join(
+            output_path, partitioning.format(partition_expr)[0]
+        )
+
+        partition_df = new_records[
+            new_records["_cell"].isin(partition_delta.index)
+        ].drop(columns=["_cell"])
+
+        # Keep the existing records of the other cells (anti-join on the key
+        # columns within the partition). Without such columns, the delta cell
+        # is the whole partition and none of them is kept.
+        cell_cols = [col for col in key_cols if col not in partition_cols]
+        if cell_cols and os_path_exists(partition_dir):
+            old_files = [
+                os_path_join(partition_dir, proc_file)
+                for proc_file in os_listdir(partition_dir)
+                if proc_file.endswith(".parquet")
+            ]
+            old_df = pa_dataset.dataset(
+                old_files, schema=file_schema, format="parquet"
+            ).to_table().to_pandas()
+            old_df = old_df.merge(
+                partition_delta[cell_cols],
+                on=cell_cols,
+                how="left",
+                indicator=True,
+            )
+            old_df = old_df[old_df["_merge"] == "left_only"].drop(columns=["_merge"])
+            partition_df = pd.concat([old_df, partition_df], ignore_index=True)
+
+        # Write the new partition into a sibling directory and swap it in
+        tmp_dir = obtain_sibling_path(partition_dir, "tmp")
+        remove_path(tmp_dir)
+        os_makedirs(tmp_dir)
+        pq.write_table(
+            pa.Table.from_pandas(
+                partition_df[file_schema.names],
+                schema=file_schema,
+                preserve_index=False,
+            ),
+            os_path_join(tmp_dir, "part-0.parquet"),
+        )
+        swap_path(tmp_dir, partition_dir)
+
+        updated_partitions.append(partition_dir)
+        log_info(f"Updated partition {partition_dir} ({len(partition_df)} records)")
+
+    return updated_partitions
@@ -6,38 +6,230 @@ from os import makedirs as os_makedirs
 from process.model.utils import check_deps_charts
 
 
-def get_target_values(group, prob_mapping):
+def check_sampling(sampling):
+    if sampling not in ["random", "integerized"]:
+        raise ValueError(
+            f"Unknown sampling '{sampling}', expected 'random' or 'integerized'."
+        )
+
+
+def build_alias_tables(group_offsets, weights):
     """
-    Helper function to generate target values.
-    Returns a Series to be assigned directly to the dataframe.
+    Builds Walker/Vose alias tables for many discrete distributions at once.
+
+    The distributions are stored back to back in flat arrays: the entries of
+    group g are weights[group_offsets[g]:group_offsets[g + 1]].
+
+    Args:
+        group_offsets (numpy.ndarray): Start of each group in the flat arrays,
+            with the total number of entries appended (length n_groups + 1).
+        weights (numpy.ndarray): Normalized weights of every entry.
+
+    Returns:
+        tuple: (prob, alias) flat arrays, where prob is the probability of
+            keeping an entry and alias the flat index of its alternative.
     """
-    keys = group.name if isinstance(group.name, tuple) else (group.name,)
+    prob = np.ones(len(weights), dtype=np.float64)
+    alias = np.arange(len(weights), dtype=np.int64)
 
-    if keys in prob_mapping:
-        target_vals, w = prob_mapping[keys]
-        return pd.Series(
-            np.random.choice(target_vals, size=len(group), p=w), index=group.index
-        )
-    else:
-        return pd.Series(np.nan, index=group.index)
+    for start, end in zip(group_offsets[:-1], group_offsets[1:]):
+        scaled = weights[start:end] * (end - start)
+        small = list(np.flatnonzero(scaled < 1.0))
+        large = list(np.flatnonzero(scaled >= 1.0))
 
+        while small and large:
+            proc_small = small.pop()
+            proc_large = large.pop()
+            prob[start + proc_small] = scaled[proc_small]
+            alias[start + proc_small] = start + proc_large
+            scaled[proc_large] += scaled[proc_small] - 1.0
+            if scaled[proc_large] < 1.0:
+                small.append(proc_large)
+            else:
+                large.append(proc_large)
 
-def stochastic_impute(
-    data_dict,
-    task_list,
-    output_dir="./output",
-    output_filename="stochastic_imputed_data.parquet",
-):
+    return prob, alias
 
-    data_dict = encode_weights(data_dict)
 
-    result_df = data_dict["seed"].copy()
+def compile_conditional_tables(check_data_agg, valid_cols, proc_target):
+    """
+    Compiles the conditional distributions P(target | valid columns) of an
+    aggregated reference table into flat arrays indexed by group code.
+
+    Args:
+        check_data_agg (pandas.DataFrame): Reference table aggregated (and
+            sorted) over valid_cols + [proc_target], with a 'probability' column.
+        valid_cols (list): The conditioning columns.
+        proc_target (str): The target column.
+
+    Returns:
+        tuple: (group_keys, t_vals, group_offsets, weights), where group_keys
+            holds the valid_cols values of each group with its code in the
+            '_group' column, t_vals the flat target values and weights their
+            probabilities, normalized within each group.
+    """
+    grouped = check_data_agg.groupby(valid_cols, sort=True)["probability"]
+    group_sizes = grouped.size().to_numpy()
+    group_offsets = np.concatenate([[0], np.cumsum(group_sizes)]).astype(np.int64)
+
+    # Normalize within each group (uniform if the group has no weight at all)
+    w = check_data_agg["probability"].to_numpy(dtype=np.float64)
+    w_sums = grouped.transform("sum").to_numpy(dtype=np.float64)
+    w = np.where(
+        w_sums > 0,
+        w / np.where(w_sums > 0, w_sums, 1.0),
+        1.0 / np.repeat(group_sizes, group_sizes),
+    )
+
+    group_keys = check_data_agg[valid_cols].iloc[group_offsets[:-1]]
+    group_keys = group_keys.assign(_group=np.arange(len(group_keys)))
+
+    return (
+        group_keys,
+        check_data_agg[proc_target].to_numpy(),
+        group_offsets,
+        w,
+    )
+
+
+def draw_from_alias_tables(group_codes, group_offsets, prob, alias):
+    """
+    Draws one entry per row from the alias tables, in O(1) per row.
+
+    Args:
+        group_codes (numpy.ndarray): Group of each row (-1 if the row has no
+            matching distribution).
+        group_offsets (numpy.ndarray): See ``build_alias_tables``.
+        prob (numpy.ndarray): See ``build_alias_tables``.
+        alias (numpy.ndarray): See ``build_alias_tables``.
+
+    Returns:
+        numpy.ndarray: Flat index of the drawn entry for each row (-1 for rows
+            without a matching distribution).
+    """
+    drawn = np.full(len(group_codes), -1, dtype=np.int64)
+    matched = group_codes >= 0
+    proc_groups = group_codes[matched]
+
+    sizes = (group_offsets[1:] - group_offsets[:-1])[proc_groups]
+    u = np.random.random_sample(len(proc_groups)) * sizes
+    slot = np.minimum(u.astype(np.int64), sizes - 1)
+    entry = group_offsets[:-1][proc_groups] + slot
+
+    drawn[matched] = np.where(u - slot < prob[entry], entry, alias[entry])
+    return drawn
+
+
+def allocate_integerized(group_codes, group_offsets, weights):
+    """
+    Allocates entries to rows with controlled rounding within each group.
+
+    For a group of n rows, the expected count of each entry (n * weight) is
+    integerized by systematic rounding with one random offset per group, so
+    every count is within 1 of its expectation and the counts sum to n. The
+    allocated values are then spread over the rows of the group in a random
+    order. All the groups are processed at once.
+
+    Args:
+        group_codes (numpy.ndarray): Group of each row (-1 if the row has no
+            matching distribution).
+        group_offsets (numpy.ndarray): See ``build_alias_tables``.
+        weights (numpy.ndarray): Normalized weights of every entry.
+
+    Returns:
+        numpy.ndarray: Flat index of the allocated entry for each row (-1 for
+            rows without a matching distribution).
+    """
+    drawn = np.full(len(group_codes), -1, dtype=np.int64)
+    n_groups = len(group_offsets) - 1
+    matched = np.flatnonzero(group_codes >= 0)
+
+    # Rows sorted by group, in a random order within each group
+    order = matched[
+        np.lexsort((np.random.random_sample(len(matched)), group_codes[matched]))
+    ]
+    group_rows = np.bincount(group_codes[matched], minlength=n_groups)
+    row_starts = np.concatenate([[0], np.cumsum(group_rows)[:-1]])
+
+    # Cumulative expected counts of each entry within its group
+    entry_groups = np.repeat(np.arange(n_groups), np.diff(group_offsets))
+    cum_weights = np.cumsum(weights)
+    group_base = np.concatenate([[0.0], cum_weights])[group_offsets[:-1]]
+    cum_expected = (cum_weights - group_base[entry_groups]) * group_rows[entry_groups]
+    # The last entry of a group always closes it exactly (no rounding drift)
+    cum_expected[group_offsets[1:] - 1] = group_rows
+
+    # Systematic rounding: entry j covers ranks [B(j - 1), B(j)) of its group,
+    # with B(j) = floor(cumulative expected count + u) and u shared by the group
+    u = np.random.random_sample(n_groups)
+    boundaries = np.clip(
+        np.floor(cum_expected + u[entry_groups]).astype(np.int64),
+        0,
+        group_rows[entry_groups],
+    )
+    boundaries += row_starts[entry_groups]
 
+    drawn[order] = np.searchsorted(boundaries, np.arange(len(order)), side="right")
+    return drawn
+
+
+def get_conditional_tables(check_data, valid_cols, proc_target, sampling="random"):
+    """
+    Aggregates a reference table over the valid columns of a missingness
+    pattern and compiles P(target | valid columns) for sampling.
+
+    Returns:
+        dict: group_keys, t_vals, group_offsets and weights (see
+            ``compile_conditional_tables``), plus prob and alias for the
+            "random" sampling.
+    """
+    # Aggregate check_data using ONLY the valid columns for this specific chunk
+    check_data_agg = check_data.groupby(valid_cols + [proc_target], as_index=False)[
+        "probability"
+    ].sum()
+
+    group_keys, t_vals, group_offsets, w = compile_conditional_tables(
+        check_data_agg, valid_cols, proc_target
+    )
+    tables = {
+        "group_keys": group_keys,
+        "t_vals": t_vals,
+        "group_offsets": group_offsets,
+        "weights": w,
+    }
+    if sampling == "random":
+        tables["prob"], tables["alias"] = build_alias_tables(group_offsets, w)
+
+    return tables
+
+
+def impute_tasks(result_df, data_dict, task_list, sampling="random", tables_cache=None):
+    """
+    Runs the task chain on a population, or on a batch of it.
+
+    Every row is imputed from its own values only, so with sampling="random"
+    running this function on consecutive batches gives the same distribution
+    as running it on the whole population at once (not the same draws). With
+    sampling="integerized", the rounding is done within each batch, so the
+    group counts are only exact per batch.
+
+    Args:
+        result_df (pandas.DataFrame): The population (or batch) to impute.
+            New target columns are added to it.
+        data_dict (dict): The reference tables, as returned by encode_weights.
+        task_list (dict): The imputation tasks.
+        sampling (str, optional): See ``stochastic_impute``.
+        tables_cache (dict or None, optional): Cache of the compiled
+            conditional tables, to be shared across batches. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: The imputed population (or batch).
+    """
     for proc_task in task_list:
 
         proc_task = proc_task.strip()
         proc_targets = task_list[proc_task]["targets"]
-        check_data = data_dict[proc_task].copy()
+        check_data = data_dict[proc_task]
 
         shared_cols = list(set(result_df.columns).intersection(check_data.columns))
         # Find all unique patterns of missing data in the shared columns
@@ -73,24 +265,39 @@ def stochastic_impute(
                     )
 
                 # --- CASE B: At least one valid column exists ---
-                # Aggregate check_data using ONLY the valid columns for this specific chunk
-                check_data_agg = check_data.groupby(
-                    valid_cols + [proc_target], as_index=False
-                )["probability"].sum()
-
-                # Build the probability mapping
-                prob_mapping = {}
-                for keys, group in check_data_agg.groupby(valid_cols):
-                    t_vals = group[proc_target].values
-                    w = group["probability"].values
-                    w = w / w.sum() if w.sum() > 0 else np.ones(len(w)) / len(w)
-
-                    keys = keys if isinstance(keys, tuple) else (keys,)
-                    prob_mapping[keys] = (t_vals, w)
-
-                # Apply the mapping to this specific subset
-                assigned_subset = subset_df.groupby(valid_cols, group_keys=False).apply(
-                    get_target_values, prob_mapping=prob_mapping, include_groups=False
+                # Compile the conditional distributions into flat tables
+                # (reused when the same pattern was seen in a previous batch)
+                cache_key = (proc_task, proc_target, tuple(valid_cols))
+                if tables_cache is not None and cache_key in tables_cache:
+                    tables = tables_cache[cache_key]
+                else:
+                    tables = get_conditional_tables(
+                        check_data, valid_cols, proc_target, sampling=sampling
+                    )
+                    if tables_cache is not None:
+                        tables_cache[cache_key] = tables
+
+                # Look up the group of each row in this subset and draw from it
+                group_codes = (
+                    subset_df[valid_cols]
+                    .merge(tables["group_keys"], on=valid_cols, how="left")["_group"]
+                    .fillna(-1)
+                    .to_numpy(dtype=np.int64)
+                )
+                if sampling == "integerized":
+                    drawn = allocate_integerized(
+                        group_codes, tables["group_offsets"], tables["weights"]
+                    )
+                else:
+                    drawn = draw_from_alias_tables(
+                        group_codes,
+                        tables["group_offsets"],
+                        tables["prob"],
+                        tables["alias"],
+                    )
+                assigned_subset = pd.Series(
+                    tables["t_vals"][drawn[drawn >= 0]],
+                    index=subset_df.index[drawn >= 0],
                 )
 
                 # Update our master column with the results from this chunk
@@ -106,18 +313,55 @@ def stochastic_impute(
                 if proc_targets[proc_target] != "category":
                     result_df[proc_target] = combined_df.mean(axis=1, skipna=True)
                 else:
-                    result_df[proc_target] = combined_df.apply(
-                        lambda row: (
-                            np.random.choice(row.dropna().values)
-                            if row.notna().any()
-                            else np.nan
-                        ),
-                        axis=1,
+                    # Randomly pick one of the available (non-NaN) values per row
+                    use_new = combined_df["existing"].isna() | (
+                        combined_df["new"].notna()
+                        & (np.random.random_sample(len(combined_df)) < 0.5)
+                    )
+                    result_df[proc_target] = combined_df["existing"].where(
+                        ~use_new, combined_df["new"]
                     )
             else:
                 # If it doesn't exist yet, just assign the new column directly
                 result_df[proc_target] = new_col
 
+    return result_df
+
+
+def stochastic_impute(
+    data_dict,
+    task_list,
+    output_dir="./output",
+    output_filename="stochastic_imputed_data.parquet",
+    sampling="random",
+):
+    """
+    Imputes the targets of every task into the seed population.
+
+    Args:
+        data_dict (dict): The seed population and the reference tables.
+        task_list (dict): The imputation tasks.
+        output_dir (str or None, optional): Where the output is saved.
+            Defaults to "./output".
+        output_filename (str, optional): Name of the output parquet file.
+        sampling (str, optional): How target values are assigned within each
+            group of rows sharing the same features:
+            - "random": independent draws for every row.
+            - "integerized": the expected counts of the group are rounded
+              (systematic allocation) and shuffled over its rows, so every
+              group matches its conditional distribution within one record.
+            Defaults to "random".
+
+    Returns:
+        pandas.DataFrame: The synthetic population.
+    """
+    check_sampling(sampling)
+
+    data_dict = encode_weights(data_dict, task_list=task_list)
+
+    result_df = data_dict["seed"].copy()
+    result_df = impute_tasks(result_df, data_dict, task_list, sampling=sampling)
+
     if output_dir is not None:
 
         if not os_path_exists(output_dir):
@@ -0,0 +1,423 @@
+import numpy as np
+import pandas as pd
+
+# A condition keeping less than 1 / SELECTIVE_RATIO of the rows is resolved
+# through its index slices, a broader one through a mask over the code columns
+SELECTIVE_RATIO = 8
+# Beyond this number of code ranges, a condition mask uses a lookup table
+MAX_CODE_RUNS = 4
+
+
+class PopulationIndex:
+    """
+    In-memory query index over a synthetic population.
+
+    Every column is factorized into integer codes (``-1`` for NaN) and
+    stored together with a sorted-code index: the row ids ordered by code
+    plus the offset of each code in that order. A single condition then
+    resolves to contiguous slices of the row ids, and multi-condition
+    queries start from the most selective condition and check the
+    remaining ones against the (much smaller) candidate set. When even the
+    most selective condition is broad, the conditions are checked on the
+    whole code columns instead (and counts never materialize the rows).
+
+    Example:
+        >>> pop_index = PopulationIndex.from_dataframe(syn_pop)
+        >>> pop_index.count({"gender": "1", "age": ["2", "3"]})
+        >>> pop_index.crosstab(["occupation", "income"], {"gender": "1"})
+        >>> pop_index.save("output/population_index.npz")
+        >>> pop_index = PopulationIndex.load("output/population_index.npz")
+    """
+
+    def __init__(self, columns: dict, n_rows: int):
+        """
+        Args:
+            columns (dict): Column name -> dict with the ``categories``,
+                ``codes``, ``order`` and ``offsets`` arrays of that column.
+            n_rows (int): Number of records in the population.
+        """
+        self.columns = columns
+        self.n_rows = n_rows
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, columns: list or None = None):
+        """
+        Builds the index from an imputed population.
+
+        Args:
+            df (pandas.DataFrame): The synthetic population
+                (e.g., the output of ``stochastic_impute``).
+            columns (list or None, optional): Columns to index. Defaults to
+                all columns.
+
+        Returns:
+            PopulationIndex: The index over the population.
+        """
+        if columns is None:
+            columns = df.columns.tolist()
+
+        index_columns = {}
+        for col in columns:
+            codes, categories = pd.factorize(df[col], sort=True)
+            codes = codes.astype(np.int32)
+            # NaN (code -1) is shifted to 0 so it gets its own slot in the index
+            shifted = codes + 1
+            order = np.argsort(shifted, kind="stable").astype(np.int64)
+            offsets = np.zeros(len(categories) + 2, dtype=np.int64)
+            offsets[1:] = np.cumsum(
+                np.bincount(shifted, minlength=len(categories) + 1)
+            )
+
+            index_columns[col] = {
+                "categories": np.asarray(categories, dtype=object),
+                "codes": codes,
+                "order": order,
+                "offsets": offsets,
+            }
+
+        return cls(index_columns, len(df))
+
+    def _lookup_codes(self, col: str, values) -> np.ndarray:
+        """
+        Translates the filter values of a column into its integer codes.
+        Values not present in the population are ignored, and NaN maps to -1.
+        """
+        if col not in self.columns:
+            raise KeyError(f"Column '{col}' is not indexed.")
+
+        if isinstance(values, (list, tuple, set, np.ndarray, pd.Index)):
+            values = list(values)
+        else:
+            values = [values]
+
+        categories = self.columns[col]["categories"]
+        lookup = {val: code for code, val in enumerate(categories)}
+
+        codes = set()
+        for val in values:
+            if pd.isna(val):
+                codes.add(-1)
+            elif val in lookup:
+                codes.add(lookup[val])
+
+        return np.array(sorted(codes), dtype=np.int64)
+
+    def _condition_size(self, col: str, codes: np.ndarray) -> int:
+        offsets = self.columns[col]["offsets"]
+        return int((offsets[codes + 2] - offsets[codes + 1]).sum())
+
+    def _condition_rows(self, col: str, codes: np.ndarray) -> np.ndarray:
+        order = self.columns[col]["order"]
+        offsets = self.columns[col]["offsets"]
+        return np.concatenate(
+            [order[offsets[code + 1] : offsets[code + 2]] for code in codes]
+            + [np.empty(0, dtype=np.int64)]
+        )
+
+    def _condition_mask(self, col: str, codes: np.ndarray, rows=None):
+        proc_codes = self.columns[col]["codes"]
+        if rows is not None:
+            proc_codes = proc_codes[rows]
+
+        # The accepted codes are sorted, so they usually form a few ranges,
+        # which are cheaper to compare against than a lookup table
+        run_starts = np.flatnonzero(np.diff(codes, prepend=codes[:1] - 2) != 1)
+        if not 0 < len(run_starts) <= MAX_CODE_RUNS:
+            # The NaN code (-1) picks the last entry of keep
+            keep = np.zeros(len(self.columns[col]["categories"]) + 1, dtype=bool)
+            keep[codes] = True
+            return keep[proc_codes]
+
+        run_ends = np.append(run_starts[1:], len(codes)) - 1
+        mask = None
+        for start, end in zip(codes[run_starts], codes[run_ends]):
+            if start == end:
+                proc_mask = proc_codes == start
+            else:
+                proc_mask = (proc_codes >= start) & (proc_codes <= end)
+            mask = proc_mask if mask is None else mask | proc_mask
+        return mask
+
+    def _match(self, filters: dict) -> tuple:
+        """
+        Resolves the filters, either as row ids (unsorted) or as a boolean
+        mask over all the rows.
+
+        When the most selective condition keeps few rows, its slices of the
+        index are the candidates and the other conditions are checked on
+        them only. Otherwise, gathering the candidates costs more than
+        checking every condition on the whole code columns, so a mask is
+        built instead.
+
+        Returns:
+            tuple: (rows, mask), one of them being None.
+        """
+        conditions = [
+            (col, self._lookup_codes(col, values)) for col, values in filters.items()
+        ]
+        conditions.sort(key=lambda item: self._condition_size(*item))
+        # Conditions keeping every row are dropped
+        conditions = [
+            item for item in conditions if self._condition_size(*item) < self.n_rows
+        ] or conditions[:1]
+
+        if self._condition_size(*conditions[0]) * SELECTIVE_RATIO <= self.n_rows:
+            rows = self._condition_rows(*conditions[0])
+            for col, codes in conditions[1:]:
+                if len(rows) == 0:
+                    break
+                rows = rows[self._condition_mask(col, codes, rows)]
+            return rows, None
+
+        mask = self._condition_mask(*conditions[0])
+        for col, codes in conditions[1:]:
+            mask &= self._condition_mask(col, codes)
+        return None, mask
+
+    def query(self, filters: dict or None = None) -> np.ndarray:
+        """
+        Returns the (sorted) row ids matching all the filters.
+
+        Args:
+            filters (dict or None, optional): Column name -> a value or a list
+                of accepted values. Conditions are combined with AND.
+                Defaults to None (all rows).
+
+        Returns:
+            numpy.ndarray: Positional row ids of the matched records.
+        """
+        if not filters:
+            return np.arange(self.n_rows, dtype=np.int64)
+
+        rows, mask = self._match(filters)
+        if rows is None:
+            return np.flatnonzero(mask)
+        return np.sort(rows)
+
+    def count(self, filters: dict or None = None) -> int:
+        """
+        Counts the records matching all the filters.
+
+        Args:
+            filters (dict or None, optional): See ``query``.
+
+        Returns:
+            int: Number of matched records.
+        """
+        if not filters:
+            return self.n_rows
+
+        if len(filters) == 1:
+            col, values = next(iter(filters.items()))
+            return self._condition_size(col, self._lookup_codes(col, values))
+
+        rows, mask = self._match(filters)
+        if rows is None:
+            return int(np.count_nonzero(mask))
+        return len(rows)
+
+    def value_counts(self, col: str, filters: dict or None = None) -> pd.Series:
+        """
+        Counts the records of each value of a column, after filtering.
+
+        Args:
+            col (str): Column to count.
+            filters (dict or None, optional): See ``query``.
+
+        Returns:
+            pandas.Series: Counts indexed by the column values (NaN excluded).
+        """
+        categories = self.columns[col]["categories"]
+
+        if not filters:
+            counts = np.diff(self.columns[col]["offsets"])[1:]
+        else:
+            codes = self.columns[col]["codes"][self.query(filters)]
+            counts = np.bincount(codes[codes >= 0], minlength=len(categories))
+
+        return pd.Series(counts, index=pd.Index(categories, name=col), name="count")
+
+    def crosstab(self, columns: list, filters: dict or None = None) -> pd.DataFrame:
+        """
+        Cross-tabulates two columns, after filtering.
+
+        Args:
+            columns (list): The two columns to cross-tabulate (rows, columns).
+            filters (dict or None, optional): See ``query``.
+
+        Returns:
+            pandas.DataFrame: Count matrix with all the observed values of
+                both columns (NaN excluded).
+        """
+        col1, col2 = columns
+        cats1 = self.columns[col1]["categories"]
+        cats2 = self.columns[col2]["categories"]
+
+        codes1 = self.columns[col1]["codes"]
+        codes2 = self.columns[col2]["codes"]
+        if filters:
+            rows = self.query(filters)
+            codes1 = codes1[rows]
+            codes2 = codes2[rows]
+
+        valid = (codes1 >= 0) & (codes2 >= 0)
+        flat_codes = codes1[valid].astype(np.int64) * len(cats2) + codes2[valid]
+        counts = np.bincount(flat_codes, minlength=len(cats1) * len(cats2))
+
+        return pd.DataFrame(
+            counts.reshape(len(cats1), len(cats2)),
+            index=pd.Index(cats1, name=col1),
+            columns=pd.Index(cats2, name=col2),
+        )
+
+    def sample(
+        self,
+        n: int,
+        filters: dict or None = None,
+        columns: list or None = None,
+        replace: bool = False,
+        seed: int or None = None,
+    ) -> pd.DataFrame:
+        """
+        Draws a random extract of the records matching the filters.
+
+        Args:
+            n (int): Number of records to draw. Without replacement (or
+                without any matched record), it is capped at the number of
+                matched records.
+            filters (dict or None, optional): See ``query``.
+            columns (list or None, optional): Columns to decode. Defaults to
+                all indexed columns.
+            replace (bool, optional): Sample with replacement. Defaults to False.
+            seed (int or None, optional): Random seed. Defaults to None.
+
+        Returns:
+            pandas.DataFrame: The decoded records, indexed by their row ids.
+        """
+        rows = self.query(filters)
+        if not replace or len(rows) == 0:
+            n = min(n, len(rows))
+
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(rows, size=n, replace=replace))
+
+        return self.decode(rows, columns)
+
+    def decode(self, rows: np.ndarray, columns: list or None = None) -> pd.DataFrame:
+        """
+        Rebuilds the original values for the given row ids.
+
+        Args:
+            rows (numpy.ndarray): Positional row ids.
+            columns (list or None, optional): Columns to decode. Defaults to
+                all indexed columns.
+
+        Returns:
+            pandas.DataFrame: The decoded records, indexed by their row ids.
+        """
+        if columns is None:
+            columns = list(self.columns)
+
+        output = {}
+        for col in columns:
+            codes = self.columns[col]["codes"][rows]
+            categories = self.columns[col]["categories"]
+            if len(categories) == 0:
+                # Column without any value (e.g., a target never imputed)
+                output[col] = np.full(len(codes), np.nan, dtype=object)
+                continue
+            values = categories[np.maximum(codes, 0)]
+            values[codes < 0] = np.nan
+            output[col] = values
+
+        return pd.DataFrame(output, index=rows)
+
+    def save(self, path: str):
+        """
+        Saves the index into a single ``.npz`` file.
+
+        Only typed arrays are written (the categories are stored as strings
+        with a per-value type tag), so the file loads without pickle.
+
+        Args:
+            path (str): Output file path.
+        """
+        arrays = {
+            "n_rows": np.array(self.n_rows),
+            "columns": np.array([str(col) for col in self.columns], dtype=str),
+        }
+        for i, col in enumerate(self.columns):
+            for key, values in self.columns[col].items():
+                if key == "categories":
+                    arrays[f"{i}_categories"], arrays[f"{i}_kinds"] = (
+                        _encode_categories(values)
+                    )
+                else:
+                    arrays[f"{i}_{key}"] = values
+
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Loads an index previously saved with ``save``.
+
+        Args:
+            path (str): Path to the ``.npz`` file.
+
+        Returns:
+            PopulationIndex: The reloaded index.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            index_columns = {}
+            for i, col in enumerate(data["columns"].tolist()):
+                index_columns[col] = {
+                    key: data[f"{i}_{key}"] for key in ["codes", "order", "offsets"]
+                }
+                index_columns[col]["categories"] = _decode_categories(
+                    data[f"{i}_categories"], data[f"{i}_kinds"]
+                )
+
+            return cls(index_columns, int(data["n_rows"]))
+
+
+_CATEGORY_KINDS = {"b": bool, "i": int, "f": float, "s": str}
+
+
+def _encode_categories(categories: np.ndarray) -> tuple:
+    """
+    Encodes the categories of a column as a string array plus a type tag per
+    value ("b", "i", "f" or "s").
+    """
+    values, kinds = [], []
+    for val in categories:
+        if isinstance(val, (bool, np.bool_)):
+            kinds.append("b")
+            val = int(val)
+        elif isinstance(val, (int, np.integer)):
+            kinds.append("i")
+        elif isinstance(val, (float, np.floating)):
+            kinds.append("f")
+            val = repr(float(val))
+        elif isinstance(val, str):
+            kinds.append("s")
+        else:
+            raise TypeError(
+                f"Cannot save category {val!r} of type {type(val).__name__}."
+            )
+        values.append(str(val))
+
+    return np.array(values, dtype=str), np.array(kinds, dtype="U1")
+
+
+def _decode_categories(values: np.ndarray, kinds: np.ndarray) -> np.ndarray:
+    """
+    Rebuilds the categories saved with ``_encode_categories``.
+    """
+    categories = np.empty(len(values), dtype=object)
+    for i, (val, kind) in enumerate(zip(values.tolist(), kinds.tolist())):
+        if kind == "b":
+            categories[i] = bool(int(val))
+        else:
+            categories[i] = _CATEGORY_KINDS[kind](val)
+    return categories
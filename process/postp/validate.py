@@ -0,0 +1,407 @@
+import numpy as np
+import pandas as pd
+from logging import info as log_info
+from os.path import join as os_path_join
+from process.postp.index import PopulationIndex
+
+
+def _encode_population(syn_pop, columns: list) -> dict:
+    """
+    Encodes the required population columns into integer codes (-1 for NaN).
+    An existing PopulationIndex is reused as is, so the population is only
+    scanned once for all the tasks.
+    """
+    if isinstance(syn_pop, PopulationIndex):
+        return {
+            col: (syn_pop.columns[col]["codes"], syn_pop.columns[col]["categories"])
+            for col in columns
+        }
+
+    encoded = {}
+    for col in columns:
+        codes, categories = pd.factorize(syn_pop[col])
+        encoded[col] = (codes.astype(np.int32), np.asarray(categories, dtype=object))
+    return encoded
+
+
+def _reference_probability(ref_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns the reference table with a normalized 'probability' column,
+    whether or not it has already been through encode_weights.
+    """
+    if "probability" in ref_df.columns:
+        return ref_df
+    ref_df = ref_df.copy()
+    ref_df["probability"] = ref_df["value"] / ref_df["value"].sum()
+    return ref_df.drop(columns=["value"])
+
+
+def _reference_codes(
+    ref_df: pd.DataFrame, encoded: dict, col: str, extend: bool = False
+) -> tuple:
+    """
+    Encodes a reference column with the population codes of that column
+    (-1 for NaN). Values absent from the population also get -1, unless
+    extend is set, in which case they get new codes after the population ones.
+
+    Returns:
+        tuple: (codes, n_codes), where n_codes is the size of the code space.
+    """
+    categories = pd.Index(encoded[col][1])
+    values = ref_df[col]
+    codes = categories.get_indexer(values).astype(np.int64)
+    if not extend:
+        return codes, len(categories)
+
+    unknown = (codes < 0) & values.notna().to_numpy()
+    new_codes, new_values = pd.factorize(values[unknown])
+    codes[unknown] = len(categories) + new_codes
+    return codes, len(categories) + len(new_values)
+
+
+def _reference_cells(
+    ref_codes: dict, valid_cols: list, proc_target: str, probability: np.ndarray
+) -> tuple:
+    """
+    Compiles the reference conditional distribution P(target | valid_cols)
+    over flat (features, target) cell codes, the same cells as the counts of
+    ``_count_cells``. Rows with a NaN key and groups without any weight are
+    dropped.
+
+    Returns:
+        tuple: (cells, cond_prob) sorted by cell.
+    """
+    n_targets = ref_codes[proc_target][1]
+    valid = ref_codes[proc_target][0] >= 0
+    for col in valid_cols:
+        valid &= ref_codes[col][0] >= 0
+
+    flat_codes = np.zeros(int(valid.sum()), dtype=np.int64)
+    for col in valid_cols + [proc_target]:
+        flat_codes *= ref_codes[col][1]
+        flat_codes += ref_codes[col][0][valid]
+
+    cells, inverse = np.unique(flat_codes, return_inverse=True)
+    cell_prob = np.bincount(inverse, weights=probability[valid])
+    _, group_inverse = np.unique(cells // n_targets, return_inverse=True)
+    group_prob = np.bincount(group_inverse, weights=cell_prob)[group_inverse]
+
+    has_weight = group_prob > 0
+    return cells[has_weight], cell_prob[has_weight] / group_prob[has_weight]
+
+
+def _count_cells(
+    encoded: dict,
+    proc_target: str,
+    n_targets: int,
+    n_features: int,
+    feature_codes: np.ndarray,
+    rows: np.ndarray,
+) -> tuple:
+    """
+    Counts the records (given by rows, with their flat feature codes) per
+    feature combination and per (features, target) cell, where the target
+    codes are laid out over n_targets values.
+
+    Both counts come from a single bincount, with a NaN target kept in its own
+    slot; np.unique is only used when the cell space is too large for it.
+
+    Returns:
+        tuple: (feature_cells, feature_counts, joint_cells, joint_counts,
+            n_missing), the joint cells only counting records with a target.
+    """
+    n_slots = n_targets + 1
+    target_codes = encoded[proc_target][0]
+    if len(rows) < len(target_codes):
+        target_codes = target_codes[rows]
+    flat_codes = feature_codes * n_slots
+    flat_codes += target_codes
+    flat_codes += 1
+
+    if n_features * n_slots <= max(4 * len(rows), 1 << 20):
+        counts = np.bincount(flat_codes, minlength=n_features * n_slots)
+        counts = counts.reshape(n_features, n_slots)
+        n_missing = int(counts[:, 0].sum())
+        feature_counts = counts.sum(axis=1)
+        feature_cells = np.flatnonzero(feature_counts)
+        joint_counts = counts[:, 1:].ravel()
+        joint_cells = np.flatnonzero(joint_counts)
+        feature_counts = feature_counts[feature_cells]
+        joint_counts = joint_counts[joint_cells]
+    else:
+        cells, counts = np.unique(flat_codes, return_counts=True)
+        feature_cells, inverse = np.unique(cells // n_slots, return_inverse=True)
+        feature_counts = np.bincount(inverse, weights=counts).astype(np.int64)
+        has_target = cells % n_slots > 0
+        n_missing = int(counts[~has_target].sum())
+        joint_cells = (cells // n_slots * n_targets + cells % n_slots - 1)[has_target]
+        joint_counts = counts[has_target]
+
+    return feature_cells, feature_counts, joint_cells, joint_counts, n_missing
+
+
+def _obtain_patterns(encoded: dict, features: list, null_cols: set) -> list:
+    """
+    Splits the records by missingness pattern of the features, once per task.
+    Only the columns in null_cols (those with NaN) can split the records.
+
+    Returns:
+        list: (valid_cols, rows, feature_codes) for each pattern, where
+            feature_codes are the flat codes of the rows over valid_cols.
+    """
+    n_rows = len(encoded[features[0]][0])
+    split_cols = [col for col in features if col in null_cols]
+
+    if not split_cols:
+        unique_patterns = [0]
+        pattern_rows = [np.arange(n_rows)]
+    else:
+        # Missingness pattern of each record as a bit mask over split_cols
+        bits_dtype = np.uint8 if len(split_cols) <= 8 else np.int64
+        null_bits = np.zeros(n_rows, dtype=bits_dtype)
+        for i, col in enumerate(split_cols):
+            null_bits |= (encoded[col][0] < 0).astype(bits_dtype) << bits_dtype(i)
+        unique_patterns = np.flatnonzero(np.bincount(null_bits))
+        pattern_rows = [
+            np.flatnonzero(null_bits == pattern) for pattern in unique_patterns
+        ]
+
+    patterns = []
+    for pattern, rows in zip(unique_patterns, pattern_rows):
+        valid_cols = [
+            col
+            for col in features
+            if col not in split_cols or not (pattern >> split_cols.index(col)) & 1
+        ]
+        feature_codes = None
+        all_rows = len(rows) == n_rows
+        for col in valid_cols:
+            proc_codes = encoded[col][0] if all_rows else encoded[col][0][rows]
+            if feature_codes is None:
+                feature_codes = proc_codes.astype(np.int64)
+            else:
+                feature_codes *= len(encoded[col][1])
+                feature_codes += proc_codes
+        patterns.append((valid_cols, rows, feature_codes))
+
+    return patterns
+
+
+def _fidelity_metrics(observed: np.ndarray, expected: np.ndarray) -> dict:
+    """
+    Computes SRMSE and total variation distance between two count vectors
+    defined over the same cells.
+    """
+    if len(observed) == 0 or expected.sum() == 0:
+        return {"srmse": np.nan, "tvd": np.nan}
+
+    srmse = np.sqrt(np.mean((observed - expected) ** 2)) / np.mean(expected)
+    tvd = 0.5 * np.abs(observed / observed.sum() - expected / expected.sum()).sum()
+    return {"srmse": srmse, "tvd": tvd}
+
+
+def validate_fidelity(
+    syn_pop,
+    data_dict: dict,
+    task_list: dict,
+    output_dir: str or None = None,
+) -> pd.DataFrame:
+    """
+    Compares the synthetic population against every reference table.
+
+    For each task and target, the population is aggregated over the task's
+    features (those available in both the population and the reference) and
+    the target, separately for each missingness pattern of the features.
+    The expected count of a cell is the number of synthetic records with
+    that feature combination times the reference conditional probability
+    P(target | features), i.e., what a perfect imputation would produce for
+    the given seed.
+
+    The metrics are computed over the cells with a non-zero observed or
+    expected count, so zero-value rows in the reference (which
+    ``encode_weights`` may drop) do not change them.
+
+    The population columns are encoded once (an existing PopulationIndex is
+    reused as is) and the reference tables are mapped onto the same codes,
+    so every aggregation is a count over integer codes and the whole
+    validation costs about one pass over the population.
+
+    Args:
+        syn_pop (pandas.DataFrame or PopulationIndex): The synthetic population
+            (e.g., the output of ``stochastic_impute``).
+        data_dict (dict): The reference tables, either raw (with 'value') or
+            as returned by ``encode_weights`` (with 'probability').
+        task_list (dict): The imputation tasks.
+        output_dir (str or None, optional): If provided, the metrics are saved
+            to ``fidelity_metrics.csv`` in this directory. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: One row per task, target and missingness pattern
+            (plus an 'ALL' pattern per task and target) with:
+            - n_records: number of records in the pattern.
+            - unmatched_rate: share of records whose feature combination does
+              not exist in the reference table.
+            - missing_target_rate: share of records with a NaN target.
+            - srmse: standardized root mean squared error of the cell counts.
+            - tvd: total variation distance between the cell distributions.
+    """
+    pop_columns = (
+        list(syn_pop.columns)
+        if isinstance(syn_pop, PopulationIndex)
+        else syn_pop.columns.tolist()
+    )
+
+    required_cols = set()
+    for proc_task in task_list:
+        task_cols = list(task_list[proc_task]["features"]) + list(
+            task_list[proc_task]["targets"]
+        )
+        required_cols.update(col for col in task_cols if col in pop_columns)
+    encoded = _encode_population(syn_pop, sorted(required_cols))
+    null_cols = {col for col in encoded if (encoded[col][0] < 0).any()}
+
+    rows = []
+    for proc_task in task_list:
+
+        proc_task = proc_task.strip()
+        ref_df = _reference_probability(data_dict[proc_task])
+
+        features = [
+            col
+            for col in task_list[proc_task]["features"]
+            if col in ref_df.columns and col in encoded
+        ]
+        if not features:
+            continue
+
+        patterns = _obtain_patterns(encoded, features, null_cols)
+        ref_codes = {col: _reference_codes(ref_df, encoded, col) for col in features}
+        probability = ref_df["probability"].to_numpy(dtype=float)
+
+        for proc_target in task_list[proc_task]["targets"]:
+
+            if proc_target not in ref_df.columns or proc_target not in encoded:
+                continue
+
+            # Reference target values absent from the population get their
+            # own codes, so their expected counts are still compared
+            ref_codes[proc_target] = _reference_codes(
+                ref_df, encoded, proc_target, extend=True
+            )
+            n_targets = ref_codes[proc_target][1]
+            all_observed, all_expected = [], []
+            total_records, total_unmatched, total_missing = 0, 0, 0
+
+            for valid_cols, pattern_rows, feature_codes in patterns:
+                n_records = len(pattern_rows)
+                total_records += n_records
+
+                if not valid_cols:
+                    n_missing = int((encoded[proc_target][0][pattern_rows] < 0).sum())
+                    rows.append(
+                        {
+                            "task": proc_task,
+                            "target": proc_target,
+                            "pattern": "",
+                            "n_records": n_records,
+                            "unmatched_rate": 1.0,
+                            "missing_target_rate": n_missing / n_records,
+                            "srmse": np.nan,
+                            "tvd": np.nan,
+                        }
+                    )
+                    total_unmatched += n_records
+                    total_missing += n_missing
+                    continue
+
+                # Reference conditional distribution P(target | valid features)
+                ref_cells, cond_prob = _reference_cells(
+                    ref_codes, valid_cols, proc_target, probability
+                )
+                ref_keys = np.unique(ref_cells // n_targets)
+
+                # Synthetic feature counts (all records) and joint counts
+                # (records with a target), over the same cells
+                feature_cells, feature_counts, joint_cells, joint_counts, n_missing = (
+                    _count_cells(
+                        encoded,
+                        proc_target,
+                        n_targets,
+                        int(np.prod([len(encoded[col][1]) for col in valid_cols])),
+                        feature_codes,
+                        pattern_rows,
+                    )
+                )
+                total_missing += n_missing
+                n_matched = feature_counts[np.isin(feature_cells, ref_keys)].sum()
+
+                is_matched = np.isin(joint_cells // n_targets, ref_keys)
+                joint_cells = joint_cells[is_matched]
+                joint_counts = joint_counts[is_matched]
+                syn_keys, syn_inverse = np.unique(
+                    joint_cells // n_targets, return_inverse=True
+                )
+                n_features = np.bincount(syn_inverse, weights=joint_counts)
+
+                # Expected counts over every cell of the matched feature keys
+                has_records = np.isin(ref_cells // n_targets, syn_keys)
+                ref_cells = ref_cells[has_records]
+                ref_expected = (
+                    n_features[np.searchsorted(syn_keys, ref_cells // n_targets)]
+                    * cond_prob[has_records]
+                )
+                cells = np.union1d(ref_cells, joint_cells)
+                observed = np.zeros(len(cells))
+                observed[np.searchsorted(cells, joint_cells)] = joint_counts
+                expected = np.zeros(len(cells))
+                expected[np.searchsorted(cells, ref_cells)] = ref_expected
+
+                # Cells that are empty on both sides are skipped, so the
+                # metrics do not depend on zero rows kept in the reference
+                non_empty = (observed > 0) | (expected > 0)
+                observed = observed[non_empty]
+                expected = expected[non_empty]
+                all_observed.append(observed)
+                all_expected.append(expected)
+
+                rows.append(
+                    {
+                        "task": proc_task,
+                        "target": proc_target,
+                        "pattern": ", ".join(valid_cols),
+                        "n_records": n_records,
+                        "unmatched_rate": 1.0 - n_matched / n_records,
+                        "missing_target_rate": n_missing / n_records,
+                        **_fidelity_metrics(observed, expected),
+                    }
+                )
+                total_unmatched += n_records - n_matched
+
+            if all_observed:
+                overall = _fidelity_metrics(
+                    np.concatenate(all_observed), np.concatenate(all_expected)
+                )
+            else:
+                overall = {"srmse": np.nan, "tvd": np.nan}
+
+            rows.append(
+                {
+                    "task": proc_task,
+                    "target": proc_target,
+                    "pattern": "ALL",
+                    "n_records": total_records,
+                    "unmatched_rate": total_unmatched / max(total_records, 1),
+                    "missing_target_rate": total_missing / max(total_records, 1),
+                    **overall,
+                }
+            )
+            log_info(
+                f"Fidelity for {proc_task}/{proc_target}: "
+                + f"SRMSE={overall['srmse']:.4f}, TVD={overall['tvd']:.4f}"
+            )
+
+    metrics_df = pd.DataFrame(rows)
+    if output_dir is not None:
+        metrics_df.to_csv(os_path_join(output_dir, "fidelity_metrics.csv"), index=False)
+
+    return metrics_df